@@ -0,0 +1,115 @@
+"""Semantic cache for agent answers keyed by query embedding."""
+import copy
+import re
+import threading
+import time
+from typing import AbstractSet, Any, Dict, List, Optional
+
+import numpy as np
+
+
+# Questions with digits (years, amounts, top-N) are never cached: two
+# questions differing only in a number embed almost identically but need
+# different answers.
+_CRITICAL_QUERY = re.compile(r"\d")
+
+
+class SemanticCache:
+    """
+    Returns a stored answer when a new question embeds close to a cached one.
+    
+    Cosine similarity alone is not enough: swapping one entity ("Beverages"
+    vs "Condiments") or a word outside the retrieval vocabulary ("highest"
+    vs "lowest") barely moves the embedding. A hit therefore also requires
+    the question's set of words to match the cached question's exactly, so
+    only rewordings that differ in case, punctuation, word order or
+    repetition are served from the cache.
+    """
+    
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600, max_entries: int = 1024):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.M: Optional[np.ndarray] = None  # L2-normalized embeddings, one row per entry
+        self.answers: List[Dict[str, Any]] = []
+        self.format_hints: List[str] = []
+        self.word_sets: List[AbstractSet[str]] = []
+        self.ts = np.empty(0)
+        # Questions may be answered from several threads at once
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def is_cacheable(question: str) -> bool:
+        """Whether answers to this question may be served from the cache."""
+        return _CRITICAL_QUERY.search(question) is None
+    
+    def lookup(
+        self,
+        q_vec: np.ndarray,
+        format_hint: str = "",
+        words: AbstractSet[str] = frozenset(),
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Find the most similar live entry with the same format hint and the
+        same set of words.
+        
+        Returns a copy of the cached answer, or None on a miss.
+        """
+        with self._lock:
+            if self.M is None or not q_vec.any():
+                return None
+            
+            sims = self.M @ q_vec
+            expired = (time.time() - self.ts) > self.ttl
+            mismatch = np.array([
+                hint != format_hint or entry_words != words
+                for hint, entry_words in zip(self.format_hints, self.word_sets)
+            ])
+            sims[expired | mismatch] = -np.inf
+            
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            return copy.deepcopy(self.answers[best])
+    
+    def insert(
+        self,
+        q_vec: np.ndarray,
+        answer: Dict[str, Any],
+        format_hint: str = "",
+        words: AbstractSet[str] = frozenset(),
+    ):
+        """Store an answer under its question embedding."""
+        if not q_vec.any():
+            return
+        
+        row = q_vec.reshape(1, -1)
+        answer = copy.deepcopy(answer)
+        with self._lock:
+            self._evict()
+            self.M = row.copy() if self.M is None else np.vstack([self.M, row])
+            self.answers.append(answer)
+            self.format_hints.append(format_hint)
+            self.word_sets.append(frozenset(words))
+            self.ts = np.append(self.ts, time.time())
+    
+    def _evict(self):
+        """Drop expired entries and the oldest beyond capacity; caller holds the lock."""
+        if self.M is None:
+            return
+        keep = np.flatnonzero((time.time() - self.ts) <= self.ttl)
+        # Leave room for the entry being inserted
+        keep = keep[max(len(keep) - (self.max_entries - 1), 0):]
+        if len(keep) == len(self.ts):
+            return
+        if len(keep) == 0:
+            self.M = None
+        else:
+            self.M = self.M[keep]
+        self.answers = [self.answers[i] for i in keep]
+        self.format_hints = [self.format_hints[i] for i in keep]
+        self.word_sets = [self.word_sets[i] for i in keep]
+        self.ts = self.ts[keep]
+    
+    def __len__(self) -> int:
+        return len(self.answers)
@@ -1,8 +1,126 @@
 """DSPy signatures and modules for the retail analytics copilot."""
 import dspy
-from typing import Literal, Optional
+from typing import Any, Dict, List, Literal, Optional
+from pathlib import Path
+import atexit
+import hashlib
 import json
+import orjson
+import os
 import re
+import threading
+
+
+# Number patterns used to pull typed answers out of LLM text
+_NUM_FLOAT = re.compile(r'-?\d+\.?\d*')
+_NUM_INT = re.compile(r'-?\d+')
+
+# SQL rows shown to the Synthesizer; the rest are summarized by count and stats
+MAX_PROMPT_ROWS = 50
+
+
+def _column_stats(rows: List[tuple], columns: List[str]) -> Dict[str, Dict[str, float]]:
+    """sum/min/max/mean over all rows for each column whose values are all numeric."""
+    stats = {}
+    for i, col in enumerate(columns):
+        values = [row[i] for row in rows if row[i] is not None]
+        if values and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+            total = sum(values)
+            stats[col] = {
+                "sum": total,
+                "min": min(values),
+                "max": max(values),
+                "mean": total / len(values),
+            }
+    return stats
+
+
+def llm_cache_enabled() -> bool:
+    """False when RAC_DISABLE_LLM_CACHE is set, e.g. to measure uncached latency."""
+    return os.environ.get("RAC_DISABLE_LLM_CACHE", "").lower() not in ("1", "true", "yes")
+
+
+def _setup_fingerprint(predictor: dspy.Module) -> str:
+    """The configured LM (model and kwargs) and the predictor's state (demos, instructions).
+    
+    Part of every ExactCache key, so switching LMs or compiling the program
+    doesn't serve outputs produced under the old setup.
+    """
+    lm = dspy.settings.lm
+    lm_part = repr((lm.model, sorted(lm.kwargs.items()))) if lm is not None else ""
+    state = orjson.dumps(predictor.dump_state(), option=orjson.OPT_SORT_KEYS, default=str)
+    return lm_part + "\x1f" + hashlib.blake2b(state, digest_size=16).hexdigest()
+
+
+class ExactCache:
+    """Exact-match cache of module outputs, persisted to disk on exit.
+    
+    Keys are a hash of the module name, the LM/predictor setup and the inputs,
+    so a hit is only returned for byte-identical calls under the same setup.
+    Only the newest max_entries are kept. Set RAC_DISABLE_LLM_CACHE=1 to bypass.
+    """
+    
+    def __init__(self, path: Path, max_entries: int = 4096):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries: Optional[Dict[str, Any]] = None
+        self._dirty = False
+        self._lock = threading.Lock()
+    
+    @property
+    def enabled(self) -> bool:
+        return llm_cache_enabled()
+    
+    def _load(self) -> Dict[str, Any]:
+        with self._lock:
+            if self._entries is None:
+                try:
+                    self._entries = orjson.loads(self.path.read_bytes())
+                except (OSError, ValueError):
+                    self._entries = {}
+                atexit.register(self.save)
+        return self._entries
+    
+    @staticmethod
+    def key(namespace: str, *parts: str) -> str:
+        h = hashlib.blake2b(namespace.encode(), digest_size=16)
+        for part in parts:
+            h.update(b"\x1f")
+            h.update(part.encode())
+        return h.hexdigest()
+    
+    def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        return self._load().get(key)
+    
+    def set(self, key: str, value: Any):
+        if not self.enabled:
+            return
+        entries = self._load()
+        with self._lock:
+            entries.pop(key, None)
+            entries[key] = value
+            # Dicts keep insertion order (also across save/load), oldest first
+            while len(entries) > self.max_entries:
+                del entries[next(iter(entries))]
+            self._dirty = True
+    
+    def save(self):
+        """Write entries to disk if anything changed."""
+        if not self._dirty or self._entries is None:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self._lock:
+                data = orjson.dumps(self._entries)
+            self.path.write_bytes(data)
+            self._dirty = False
+        except (OSError, TypeError):
+            pass
+
+
+_LLM_CACHE = ExactCache(Path(".cache") / "llm_exact.json")
 
 
 class RouterSignature(dspy.Signature):
@@ -10,7 +128,7 @@ class RouterSignature(dspy.Signature):
     
     question = dspy.InputField(desc="The user's question")
     route = dspy.OutputField(
-        desc="Route: 'rag' for policy/docs only, 'sql' for pure SQL queries, 'hybrid' for questions needing both docs and SQL"
+        desc="One of: rag | sql | hybrid. No other text. 'rag' for policy/docs only, 'sql' for pure SQL queries, 'hybrid' for questions needing both docs and SQL"
     )
 
 
@@ -40,19 +158,29 @@ class Router(dspy.Module):
     
     def __init__(self):
         super().__init__()
-        self.classify = dspy.ChainOfThought(RouterSignature)
+        # A 3-way label needs no rationale; the token cap still leaves room
+        # for the adapter's field markers around the label
+        self.classify = dspy.Predict(RouterSignature, max_tokens=32)
     
     def forward(self, question: str) -> Literal["rag", "sql", "hybrid"]:
+        cache_key = ExactCache.key("router", _setup_fingerprint(self.classify), question.strip())
+        cached = _LLM_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+        
         result = self.classify(question=question)
         route = result.route.lower().strip()
         
         # Normalize output
         if "hybrid" in route or ("sql" in route and "rag" in route):
-            return "hybrid"
+            route = "hybrid"
         elif "sql" in route:
-            return "sql"
+            route = "sql"
         else:
-            return "rag"
+            route = "rag"
+        
+        _LLM_CACHE.set(cache_key, route)
+        return route
 
 
 class NLToSQL(dspy.Module):
@@ -63,6 +191,13 @@ class NLToSQL(dspy.Module):
         self.generate = dspy.ChainOfThought(NLToSQLSignature)
     
     def forward(self, question: str, schema: str, context: str = "") -> str:
+        cache_key = ExactCache.key(
+            "nl_to_sql", _setup_fingerprint(self.generate), question.strip(), schema, context
+        )
+        cached = _LLM_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+        
         result = self.generate(
             question=question,
             db_schema=schema,
@@ -77,6 +212,7 @@ class NLToSQL(dspy.Module):
             sql = "\n".join(lines[1:-1]) if len(lines) > 2 else sql
         sql = sql.strip()
         
+        _LLM_CACHE.set(cache_key, sql)
         return sql
 
 
@@ -90,13 +226,44 @@ class Synthesizer(dspy.Module):
     def forward(
         self,
         question: str,
-        sql_results: Optional[list],
+        sql_rows: Optional[List[tuple]],
+        sql_columns: List[str],
         document_context: str,
         format_hint: str,
     ) -> tuple:
         """Returns (final_answer, citations, explanation)."""
         
-        sql_str = json.dumps(sql_results) if sql_results else "No SQL results."
+        if sql_rows:
+            # Column-oriented payload, bounded to MAX_PROMPT_ROWS rows; prompt
+            # size (and LLM latency) would otherwise grow with the result set
+            row_count = len(sql_rows)
+            omitted = row_count - MAX_PROMPT_ROWS
+            payload = {
+                "columns": sql_columns,
+                "preview": sql_rows[:MAX_PROMPT_ROWS],
+                "row_count": row_count,
+                "note": f"... ({omitted} more rows omitted)" if omitted > 0 else "",
+            }
+            if row_count > 1:
+                # Precomputed so the LLM doesn't have to reduce rows itself
+                payload["stats"] = _column_stats(sql_rows, sql_columns)
+            sql_str = orjson.dumps(payload).decode()
+        else:
+            sql_str = "No SQL results."
+        
+        cache_key = ExactCache.key(
+            "synthesizer",
+            _setup_fingerprint(self.synthesize),
+            question.strip(),
+            sql_str,
+            document_context,
+            format_hint,
+        )
+        cached = _LLM_CACHE.get(cache_key)
+        if cached is not None:
+            final_answer, citations, explanation = cached
+            # Callers extend citations in place, so hand out a copy
+            return final_answer, list(citations), explanation
         
         result = self.synthesize(
             question=question,
@@ -109,7 +276,7 @@ class Synthesizer(dspy.Module):
         citations_str = result.citations.strip()
         if citations_str.startswith("[") or citations_str.startswith("'"):
             try:
-                citations = json.loads(citations_str)
+                citations = orjson.loads(citations_str)
             except:
                 # Fallback: try to extract from string
                 citations = [c.strip().strip("'\"") for c in citations_str.strip("[]").split(",")]
@@ -121,17 +288,21 @@ class Synthesizer(dspy.Module):
         try:
             # Try to parse as JSON if it looks like JSON
             if answer_str.startswith("{") or answer_str.startswith("["):
-                final_answer = json.loads(answer_str)
+                try:
+                    final_answer = orjson.loads(answer_str)
+                except orjson.JSONDecodeError:
+                    # orjson is strict; stdlib also accepts NaN/Infinity
+                    final_answer = json.loads(answer_str)
             elif format_hint == "int":
                 # Extract number from string if needed
-                numbers = re.findall(r'-?\d+\.?\d*', answer_str)
+                numbers = _NUM_FLOAT.findall(answer_str)
                 if numbers:
                     final_answer = int(float(numbers[0]))
                 else:
                     final_answer = int(float(answer_str))
             elif format_hint == "float":
                 # Extract number from string if needed
-                numbers = re.findall(r'-?\d+\.?\d*', answer_str)
+                numbers = _NUM_FLOAT.findall(answer_str)
                 if numbers:
                     final_answer = round(float(numbers[0]), 2)
                 else:
@@ -141,15 +312,16 @@ class Synthesizer(dspy.Module):
         except Exception as e:
             # If parsing fails, try to extract the answer more carefully
             if format_hint == "int":
-                numbers = re.findall(r'-?\d+', answer_str)
+                numbers = _NUM_INT.findall(answer_str)
                 final_answer = int(numbers[0]) if numbers else 0
             elif format_hint == "float":
-                numbers = re.findall(r'-?\d+\.?\d*', answer_str)
+                numbers = _NUM_FLOAT.findall(answer_str)
                 final_answer = round(float(numbers[0]), 2) if numbers else 0.0
             else:
                 final_answer = answer_str
         
         explanation = result.explanation.strip()
         
+        _LLM_CACHE.set(cache_key, [final_answer, list(citations), explanation])
         return final_answer, citations, explanation
 
@@ -1,15 +1,89 @@
 """LangGraph implementation for hybrid RAG + SQL agent."""
-from typing import TypedDict, List, Dict, Any, Optional, Literal
+from typing import AsyncIterator, TypedDict, List, Dict, Any, Optional, Literal, Tuple
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import StateGraph, END
+from langgraph.graph.state import CompiledStateGraph
+import asyncio
+import concurrent.futures
+import itertools
 import json
+import re
+from pathlib import Path
 import traceback
 import dspy
 
-from agent.dspy_signatures import Router, NLToSQL, Synthesizer
+from agent.cache.semantic import SemanticCache
+from agent.dspy_signatures import Router, NLToSQL, Synthesizer, llm_cache_enabled
 from agent.rag.retrieval import TFIDFRetriever
 from agent.tools.sqlite_tool import SQLiteTool
 
 
+# Ollama model; the name must match exactly what was pulled
+OLLAMA_MODEL = "phi3.5:3.8b-mini-instruct-q4_K_M"
+OLLAMA_API_BASE = "http://localhost:11434"
+# SELECT results kept by the agent's SQLiteTool; questions in a batch often
+# generate the same SQL, and Northwind is read-only while the agent runs
+SQL_RESULT_CACHE_SIZE = 128
+# Larger results (e.g. SELECT * over Order Details) are re-run, not kept
+SQL_RESULT_CACHE_MAX_ROWS = 200
+# DSPy's on-disk cache of LM responses, shared across runs
+LLM_DISK_CACHE_DIR = Path.home() / ".retail_copilot_cache"
+
+
+def build_ollama_lm(model_name: str = OLLAMA_MODEL) -> dspy.LM:
+    """
+    Create the DSPy LM for a local Ollama model.
+    
+    keep_alive=-1 keeps the model loaded in Ollama between calls instead
+    of reloading it.
+    Responses are cached on disk in LLM_DISK_CACHE_DIR, keyed by the full
+    request (model, messages, sampling settings), so re-runs skip Ollama.
+    """
+    cache = llm_cache_enabled()
+    # Older DSPy releases have no configure_cache
+    if cache and hasattr(dspy, "configure_cache"):
+        dspy.configure_cache(
+            enable_disk_cache=True,
+            enable_memory_cache=True,
+            disk_cache_dir=str(LLM_DISK_CACHE_DIR),
+        )
+    return dspy.LM(
+        model=f"ollama/{model_name}",
+        api_base=OLLAMA_API_BASE,
+        model_type="chat",
+        num_ctx=4096,
+        max_tokens=512,  # sent to Ollama as num_predict
+        extra_body={"keep_alive": -1},
+        cache=cache,
+    )
+
+
+def _run_sync(coro):
+    """Run a coroutine to completion from sync code, even inside a running event loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # A running loop (Jupyter, an async app) can't be re-entered, so run on a
+    # private loop in a helper thread and block until it finishes
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+
+# ISO dates (YYYY-MM-DD) in questions and docs
+_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+# Product categories from the catalog
+_CATEGORIES = ["Beverages", "Condiments", "Confections", "Dairy Products",
+               "Grains/Cereals", "Meat/Poultry", "Produce", "Seafood"]
+_CATEGORIES_LOWER = [cat.lower() for cat in _CATEGORIES]
+
+# KPI name -> pattern detecting it in a question
+_KPI_PATTERNS = {
+    "AOV": re.compile(r"\b(aov|average order value)\b", re.I),
+    "Gross Margin": re.compile(r"\bmargin", re.I),
+}
+
 class AgentState(TypedDict):
     """State for the agent graph."""
     question: str
@@ -17,8 +91,9 @@ class AgentState(TypedDict):
     route: Optional[Literal["rag", "sql", "hybrid"]]
     retrieved_chunks: List[Dict[str, Any]]
     constraints: Dict[str, Any]  # Extracted dates, KPIs, categories, etc.
+    kpi_to_chunks: Dict[str, List[int]]  # KPI name -> indices of retrieved chunks defining it
     sql_query: Optional[str]
-    sql_results: Optional[List[Dict[str, Any]]]
+    sql_rows: Optional[List[tuple]]
     sql_error: Optional[str]
     sql_columns: List[str]
     final_answer: Optional[Any]
@@ -29,16 +104,40 @@ class AgentState(TypedDict):
     trace: List[str]
 
 
+def _dispatch(name: str):
+    """Graph callable forwarding to method `name` of the agent running the graph."""
+    def call(state: AgentState, config: RunnableConfig):
+        return getattr(config["configurable"]["agent"], name)(state)
+    return call
+
+
+def _dispatch_async(name: str):
+    """Async variant of _dispatch for coroutine node methods."""
+    async def call(state: AgentState, config: RunnableConfig):
+        return await getattr(config["configurable"]["agent"], name)(state)
+    return call
+
+
 class HybridAgent:
     """Hybrid RAG + SQL agent using LangGraph."""
     
+    # Compiled once per process and shared by all instances; nodes find the
+    # running agent in the invocation config (see _dispatch)
+    _COMPILED_GRAPH: Optional[CompiledStateGraph] = None
+    # DSPy modules, shared the same way
+    _MODULES: Optional[Tuple[Router, NLToSQL, Synthesizer]] = None
+    
     def __init__(
         self,
         db_path: str,
         docs_dir: str,
         llm: Any = None,  # DSPy LM
     ):
-        self.db_tool = SQLiteTool(db_path)
+        self.db_tool = SQLiteTool(
+            db_path,
+            result_cache_size=SQL_RESULT_CACHE_SIZE,
+            result_cache_max_rows=SQL_RESULT_CACHE_MAX_ROWS,
+        )
         self.retriever = TFIDFRetriever(docs_dir)
         
         # Initialize DSPy modules
@@ -47,40 +146,48 @@ class HybridAgent:
         else:
             # Try to setup default LM with Ollama
             try:
-                # Use full model name that matches what was pulled
-                lm = dspy.LM(model="ollama/phi3.5:3.8b-mini-instruct-q4_K_M", api_base="http://localhost:11434")
-                dspy.configure(lm=lm)
+                dspy.configure(lm=build_ollama_lm())
             except:
                 pass
         
-        self.router = Router()
-        self.nl_to_sql = NLToSQL()
-        self.synthesizer = Synthesizer()
+        if HybridAgent._MODULES is None:
+            HybridAgent._MODULES = (Router(), NLToSQL(), Synthesizer())
+        self.router, self.nl_to_sql, self.synthesizer = HybridAgent._MODULES
+        self.semantic_cache = SemanticCache()
         
         # Build graph
-        self.graph = self._build_graph()
+        if HybridAgent._COMPILED_GRAPH is None:
+            HybridAgent._COMPILED_GRAPH = self._build_graph()
+    
+    @property
+    def _graph(self) -> CompiledStateGraph:
+        """The shared compiled workflow; async-only, and its nodes need self._config()."""
+        return HybridAgent._COMPILED_GRAPH
+    
+    def _config(self, **extra: Any) -> RunnableConfig:
+        """Invocation config binding the shared graph to this agent."""
+        return {"configurable": {"agent": self}, **extra}
     
-    def _build_graph(self) -> StateGraph:
+    @staticmethod
+    def _build_graph() -> CompiledStateGraph:
         """Build the LangGraph workflow."""
         workflow = StateGraph(AgentState)
         
         # Add nodes
-        workflow.add_node("router", self._route_node)
-        workflow.add_node("retriever", self._retrieve_node)
-        workflow.add_node("planner", self._plan_node)
-        workflow.add_node("sql_generator", self._sql_generator_node)
-        workflow.add_node("executor", self._executor_node)
-        workflow.add_node("synthesizer", self._synthesizer_node)
-        workflow.add_node("repair", self._repair_node)
+        workflow.add_node("prefetch", _dispatch_async("_prefetch_node"))
+        workflow.add_node("planner", _dispatch("_plan_node"))
+        workflow.add_node("sql_generator", _dispatch("_sql_generator_node"))
+        workflow.add_node("executor", _dispatch("_executor_node"))
+        workflow.add_node("synthesizer", _dispatch("_synthesizer_node"))
+        workflow.add_node("repair", _dispatch("_repair_node"))
         
         # Set entry point
-        workflow.set_entry_point("router")
+        workflow.set_entry_point("prefetch")
         
         # Add edges
-        workflow.add_edge("router", "retriever")
         workflow.add_conditional_edges(
-            "retriever",
-            self._should_plan,
+            "prefetch",
+            _dispatch("_should_plan"),
             {
                 "plan": "planner",
                 "skip_plan": "synthesizer",
@@ -90,7 +197,7 @@ class HybridAgent:
         workflow.add_edge("sql_generator", "executor")
         workflow.add_conditional_edges(
             "executor",
-            self._check_execution,
+            _dispatch("_check_execution"),
             {
                 "success": "synthesizer",
                 "repair": "repair",
@@ -99,7 +206,7 @@ class HybridAgent:
         )
         workflow.add_conditional_edges(
             "synthesizer",
-            self._check_synthesis,
+            _dispatch("_check_synthesis"),
             {
                 "done": END,
                 "repair": "repair",
@@ -107,7 +214,7 @@ class HybridAgent:
         )
         workflow.add_conditional_edges(
             "repair",
-            self._check_repair,
+            _dispatch("_check_repair"),
             {
                 "retry": "sql_generator",
                 "give_up": "synthesizer",
@@ -116,18 +223,20 @@ class HybridAgent:
         
         return workflow.compile()
     
-    def _route_node(self, state: AgentState) -> AgentState:
-        """Route the question."""
-        state["trace"].append("Routing question...")
-        route = self.router(question=state["question"])
+    async def _prefetch_node(self, state: AgentState) -> AgentState:
+        """Route the question and retrieve documents concurrently.
+        
+        Routing and retrieval are independent, so the LLM route decision
+        overlaps with TF-IDF retrieval and warming the schema cache.
+        """
+        state["trace"].append("Routing question and retrieving documents...")
+        route, chunks, _ = await asyncio.gather(
+            asyncio.to_thread(self.router, question=state["question"]),
+            asyncio.to_thread(self.retriever.retrieve, state["question"], 5),
+            asyncio.to_thread(self.db_tool.get_schema_string),
+        )
         state["route"] = route
         state["trace"].append(f"Routed to: {route}")
-        return state
-    
-    def _retrieve_node(self, state: AgentState) -> AgentState:
-        """Retrieve relevant document chunks."""
-        state["trace"].append("Retrieving documents...")
-        chunks = self.retriever.retrieve(state["question"], top_k=5)
         state["retrieved_chunks"] = [chunk.to_dict() for chunk in chunks]
         state["trace"].append(f"Retrieved {len(chunks)} chunks")
         return state
@@ -152,26 +261,30 @@ class HybridAgent:
         # Extract from retrieved chunks
         context_text = "\n".join([chunk["content"] for chunk in state["retrieved_chunks"]])
         
-        # Simple extraction patterns
-        import re
-        
         # Extract dates (YYYY-MM-DD)
-        date_pattern = r"\d{4}-\d{2}-\d{2}"
-        dates = re.findall(date_pattern, context_text + " " + state["question"])
+        dates = _DATE.findall(context_text + " " + state["question"])
         constraints["dates"] = list(set(dates))
         
         # Extract categories (from catalog or question)
-        categories = ["Beverages", "Condiments", "Confections", "Dairy Products", 
-                     "Grains/Cereals", "Meat/Poultry", "Produce", "Seafood"]
-        for cat in categories:
-            if cat.lower() in (context_text + " " + state["question"]).lower():
+        # Chunks are newline-joined, so a name can't match across two of them
+        question_lower = state["question"].lower()
+        context_lower = context_text.lower()
+        for cat, cat_lower in zip(_CATEGORIES, _CATEGORIES_LOWER):
+            if cat_lower in question_lower or cat_lower in context_lower:
                 constraints["categories"].append(cat)
         
         # Extract KPIs
-        if "aov" in state["question"].lower() or "average order value" in state["question"].lower():
-            constraints["kpis"].append("AOV")
-        if "margin" in state["question"].lower() or "gross margin" in state["question"].lower():
-            constraints["kpis"].append("Gross Margin")
+        for kpi, pattern in _KPI_PATTERNS.items():
+            if pattern.search(state["question"]):
+                constraints["kpis"].append(kpi)
+        
+        # Index which retrieved chunks mention each KPI, in one pass over chunks
+        kpi_to_chunks: Dict[str, List[int]] = {}
+        for idx, chunk in enumerate(state["retrieved_chunks"]):
+            for kpi, pattern in _KPI_PATTERNS.items():
+                if pattern.search(chunk["content"]):
+                    kpi_to_chunks.setdefault(kpi, []).append(idx)
+        state["kpi_to_chunks"] = kpi_to_chunks
         
         state["constraints"] = constraints
         state["trace"].append(f"Extracted constraints: {constraints}")
@@ -191,9 +304,14 @@ class HybridAgent:
             context_parts.append(f"Categories: {', '.join(state['constraints']['categories'])}")
         
         if state["constraints"].get("kpis"):
-            for chunk in state["retrieved_chunks"]:
-                if any(kpi.lower() in chunk["content"].lower() for kpi in state["constraints"]["kpis"]):
-                    context_parts.append(f"KPI definition: {chunk['content'][:200]}")
+            chunk_ids = {
+                idx
+                for kpi in state["constraints"]["kpis"]
+                for idx in state["kpi_to_chunks"].get(kpi, [])
+            }
+            for idx in sorted(chunk_ids):
+                chunk = state["retrieved_chunks"][idx]
+                context_parts.append(f"KPI definition: {chunk['content'][:200]}")
         
         context = "\n".join(context_parts)
         schema = self.db_tool.get_schema_string()
@@ -216,12 +334,12 @@ class HybridAgent:
         
         if error:
             state["sql_error"] = error
-            state["sql_results"] = None
+            state["sql_rows"] = None
             state["sql_columns"] = []
             state["trace"].append(f"SQL error: {error}")
         else:
             state["sql_error"] = None
-            state["sql_results"] = rows
+            state["sql_rows"] = rows
             state["sql_columns"] = columns
             state["trace"].append(f"SQL executed: {len(rows) if rows else 0} rows")
         
@@ -234,7 +352,7 @@ class HybridAgent:
                 return "repair"
             return "fail"
         
-        if state["sql_results"] is None or len(state["sql_results"]) == 0:
+        if state["sql_rows"] is None or len(state["sql_rows"]) == 0:
             # Empty results might be valid, but check if question expects data
             if "top" in state["question"].lower() or "highest" in state["question"].lower():
                 if state["repair_count"] < 2:
@@ -252,26 +370,21 @@ class HybridAgent:
             for chunk in state["retrieved_chunks"][:3]  # Top 3 chunks
         ])
         
-        sql_results = state.get("sql_results")
-        
         try:
             final_answer, citations, explanation = self.synthesizer(
                 question=state["question"],
-                sql_results=sql_results,
+                sql_rows=state.get("sql_rows"),
+                sql_columns=state.get("sql_columns", []),
                 document_context=doc_context,
                 format_hint=state["format_hint"],
             )
             
             # Add table citations from SQL
-            if state["sql_query"]:
-                tables_used = []
-                for table in self.db_tool.get_table_names():
-                    if table.lower() in state["sql_query"].lower():
-                        tables_used.append(table)
-                citations.extend(tables_used)
+            tables_used = self.db_tool.tables_in_query(state["sql_query"]) if state["sql_query"] else []
             
-            # Deduplicate citations
-            citations = list(dict.fromkeys(citations))  # Preserves order
+            # Deduplicate citations in one pass (preserves order)
+            if tables_used or len(citations) >= 2:
+                citations = list(dict.fromkeys(itertools.chain(citations, tables_used)))
             
             state["final_answer"] = final_answer
             state["citations"] = citations
@@ -297,7 +410,7 @@ class HybridAgent:
         confidence = 0.5  # Base confidence
         
         # Boost if SQL executed successfully
-        if state["sql_results"] is not None and not state["sql_error"]:
+        if state["sql_rows"] is not None and not state["sql_error"]:
             confidence += 0.2
         
         # Boost if we have good document retrieval
@@ -358,15 +471,119 @@ class HybridAgent:
         return "retry"
     
     def run(self, question: str, format_hint: str) -> Dict[str, Any]:
-        """Run the agent on a question."""
-        initial_state: AgentState = {
+        """
+        Run the agent on a question, blocking until it is answered.
+        
+        Synchronous wrapper around arun(). Safe to call from inside a running
+        event loop (e.g. Jupyter), though that loop is blocked meanwhile;
+        async callers should await arun() instead.
+        """
+        return _run_sync(self.arun(question, format_hint))
+    
+    async def arun(self, question: str, format_hint: str) -> Dict[str, Any]:
+        """Run the agent on a question from inside an event loop."""
+        results = await self.arun_batch([question], [format_hint])
+        return results[0]
+    
+    def run_batch(
+        self,
+        questions: List[str],
+        format_hints: List[str],
+        max_concurrency: int = 8,
+    ) -> List[Dict[str, Any]]:
+        """
+        Run the agent on many questions, overlapping their LLM and SQL calls.
+        
+        Synchronous wrapper around arun_batch(), callable like run().
+        """
+        return _run_sync(self.arun_batch(questions, format_hints, max_concurrency))
+    
+    async def arun_batch(
+        self,
+        questions: List[str],
+        format_hints: List[str],
+        max_concurrency: int = 8,
+    ) -> List[Dict[str, Any]]:
+        """
+        Run the agent on many questions from inside an event loop.
+        
+        Returns one result per question, in input order.
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(questions)
+        async for idx, result in self.arun_as_completed(questions, format_hints, max_concurrency):
+            results[idx] = result
+        return results
+    
+    async def arun_as_completed(
+        self,
+        questions: List[str],
+        format_hints: List[str],
+        max_concurrency: int = 8,
+        return_exceptions: bool = False,
+    ) -> AsyncIterator[Tuple[int, Any]]:
+        """
+        Run the agent on many questions, yielding (index, result) as each finishes.
+        
+        With return_exceptions, a failed question yields its exception as the
+        result instead of aborting the rest. Every question is looked up in the
+        semantic cache before any answer is added to it, so the cache only
+        helps across separate calls (e.g. repeated run()), not within a batch.
+        """
+        pending = []  # (index, (question vector, word set) or None) for cache misses
+        
+        # Serve repeated (reworded) questions from the semantic cache
+        for idx, (question, format_hint) in enumerate(zip(questions, format_hints)):
+            if not SemanticCache.is_cacheable(question):
+                pending.append((idx, None))
+                continue
+            q_vec = self.retriever.embed(question)
+            words = self.retriever.word_set(question)
+            cached = self.semantic_cache.lookup(q_vec, format_hint, words)
+            if cached is not None:
+                cached["trace"] = ["Semantic cache hit"]
+                yield idx, cached
+            else:
+                pending.append((idx, (q_vec, words)))
+        
+        if not pending:
+            return
+        
+        # The compiled graph runs the questions concurrently, each node's
+        # LLM/SQL work in the executor, bounded by max_concurrency
+        async for pos, final_state in self._graph.abatch_as_completed(
+            [self._initial_state(questions[idx], format_hints[idx]) for idx, _ in pending],
+            config=self._config(max_concurrency=max_concurrency),
+            return_exceptions=return_exceptions,
+        ):
+            idx, cache_key = pending[pos]
+            if isinstance(final_state, Exception):
+                yield idx, final_state
+                continue
+            
+            result = {
+                "final_answer": final_state["final_answer"],
+                "sql": final_state.get("sql_query", ""),
+                "confidence": final_state["confidence"],
+                "explanation": final_state["explanation"],
+                "citations": final_state["citations"],
+                "trace": final_state["trace"],
+            }
+            if cache_key is not None and result["final_answer"] is not None:
+                q_vec, words = cache_key
+                self.semantic_cache.insert(q_vec, result, format_hints[idx], words)
+            yield idx, result
+    
+    def _initial_state(self, question: str, format_hint: str) -> AgentState:
+        """Fresh graph state for a question."""
+        return {
             "question": question,
             "format_hint": format_hint,
             "route": None,
             "retrieved_chunks": [],
             "constraints": {},
+            "kpi_to_chunks": {},
             "sql_query": None,
-            "sql_results": None,
+            "sql_rows": None,
             "sql_error": None,
             "sql_columns": [],
             "final_answer": None,
@@ -376,15 +593,3 @@ class HybridAgent:
             "repair_count": 0,
             "trace": [],
         }
-        
-        final_state = self.graph.invoke(initial_state)
-        
-        return {
-            "final_answer": final_state["final_answer"],
-            "sql": final_state.get("sql_query", ""),
-            "confidence": final_state["confidence"],
-            "explanation": final_state["explanation"],
-            "citations": final_state["citations"],
-            "trace": final_state["trace"],
-        }
-
@@ -1,9 +1,32 @@
 """RAG retrieval system using TF-IDF."""
+import copy
+import hashlib
 import re
 from pathlib import Path
-from typing import List, Dict, Tuple
-from collections import Counter
-import math
+from typing import List, Dict, Iterator, Optional, Tuple
+
+import joblib
+import numpy as np
+import orjson
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+
+# Tokens of 3+ word characters
+_TOKEN_PATTERN = r"\b\w{3,}\w*\b"
+# Blank lines separate paragraphs (chunks)
+_PARA = re.compile(r"\n\s*\n")
+# Every word, including the short ones the vectorizer skips
+_WORD_RE = re.compile(r"\w+")
+
+# Corpora up to this size are scored with a dense GEMV, which beats SpMV
+_DENSE_MAX_CHUNKS = 1000
+_DENSE_MAX_VOCAB = 5000
+
+# Built indexes are persisted here, one directory per docs signature
+_INDEX_CACHE_DIR = Path(".cache") / "tfidf"
+# Bump when the vectorizer settings or on-disk layout change
+_INDEX_VERSION = 1
 
 
 class Chunk:
@@ -27,92 +50,113 @@ class Chunk:
 class TFIDFRetriever:
     """Simple TF-IDF retriever for document search."""
     
-    def __init__(self, docs_dir: str):
+    def __init__(self, docs_dir: str, cache_dir: Optional[str] = None):
         self.docs_dir = Path(docs_dir)
         self.chunks: List[Chunk] = []
-        self.vocab: Dict[str, int] = {}
-        self.idf: Dict[str, float] = {}
-        self.chunk_vectors: List[Dict[str, float]] = []
-        self._load_documents()
-        self._build_index()
-    
-    def _load_documents(self):
-        """Load and chunk documents from docs directory."""
-        chunk_id_counter = {}
+        self.X_dense: Optional[np.ndarray] = None
         
+        # Reuse the persisted index while the docs are unchanged
+        index_dir = (Path(cache_dir) if cache_dir else _INDEX_CACHE_DIR) / self._signature()
+        if not self._load_index(index_dir):
+            self._build_index()
+            if self.chunks:
+                self._save_index(index_dir)
+        
+        if self.X.shape[0] <= _DENSE_MAX_CHUNKS and self.X.shape[1] <= _DENSE_MAX_VOCAB:
+            self.X_dense = self.X.toarray()
+    
+    def _signature(self) -> str:
+        """Hash of the docs directory listing and mtimes, keying the index cache."""
+        files = sorted((p.name, p.stat().st_mtime_ns) for p in self.docs_dir.glob("*.md"))
+        key = repr((_INDEX_VERSION, str(self.docs_dir.resolve()), files))
+        return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    
+    def _build_index(self):
+        """Chunk the docs and fit the TF-IDF vectorizer on them."""
+        texts: List[str] = []
+        for chunk in self._iter_chunks():
+            self.chunks.append(chunk)
+            texts.append(chunk.content)
+        # Unigrams and bigrams
+        self.vectorizer = TfidfVectorizer(
+            lowercase=True,
+            token_pattern=_TOKEN_PATTERN,
+            sublinear_tf=True,
+            norm="l2",
+            ngram_range=(1, 2),
+            dtype=np.float32,
+        )
+        if self.chunks:
+            self.X: csr_matrix = self.vectorizer.fit_transform(texts)
+            self.X.sort_indices()
+        else:
+            self.X = csr_matrix((0, 0), dtype=np.float32)
+    
+    def _save_index(self, index_dir: Path):
+        """Persist the CSR arrays, vectorizer and chunk metadata."""
+        try:
+            index_dir.mkdir(parents=True, exist_ok=True)
+            np.save(index_dir / "data.npy", self.X.data)
+            np.save(index_dir / "indices.npy", self.X.indices)
+            np.save(index_dir / "indptr.npy", self.X.indptr)
+            joblib.dump(self.vectorizer, index_dir / "vectorizer.joblib")
+            # Written last: its presence marks a complete index
+            meta = {
+                "shape": self.X.shape,
+                "chunks": [[c.chunk_id, c.content, c.source] for c in self.chunks],
+            }
+            (index_dir / "chunks.json").write_bytes(orjson.dumps(meta))
+        except OSError:
+            pass  # Caching is best-effort, e.g. on a read-only checkout
+    
+    def _load_index(self, index_dir: Path) -> bool:
+        """Load a persisted index (the CSR arrays and fitted vectorizer). Returns success."""
+        meta_path = index_dir / "chunks.json"
+        if not meta_path.exists():
+            return False
+        try:
+            meta = orjson.loads(meta_path.read_bytes())
+            arrays = [
+                np.load(index_dir / f"{name}.npy")
+                for name in ("data", "indices", "indptr")
+            ]
+            self.X = csr_matrix(tuple(arrays), shape=tuple(meta["shape"]))
+            self.vectorizer = joblib.load(index_dir / "vectorizer.joblib")
+            self.chunks = [Chunk(*c) for c in meta["chunks"]]
+        except Exception:
+            self.chunks = []
+            return False
+        return True
+    
+    def _iter_chunks(self) -> Iterator[Chunk]:
+        """Yield paragraph-level chunks from the docs directory, one file at a time."""
         for doc_file in self.docs_dir.glob("*.md"):
             content = doc_file.read_text(encoding="utf-8")
             source = doc_file.stem
             
-            # Simple paragraph-level chunking
-            paragraphs = re.split(r"\n\s*\n", content)
+            # Simple paragraph-level chunking; a blank line needs two newlines,
+            # so smaller docs are a single paragraph
+            paragraphs = _PARA.split(content) if content.count("\n") >= 2 else [content]
             
-            for idx, para in enumerate(paragraphs):
+            chunk_idx = 0
+            for para in paragraphs:
                 para = para.strip()
                 if len(para) < 10:  # Skip very short paragraphs
                     continue
                 
-                if source not in chunk_id_counter:
-                    chunk_id_counter[source] = 0
-                else:
-                    chunk_id_counter[source] += 1
-                
-                chunk_id = f"{source}::chunk{chunk_id_counter[source]}"
-                self.chunks.append(Chunk(chunk_id, para, source))
+                yield Chunk(f"{source}::chunk{chunk_idx}", para, source)
+                chunk_idx += 1
     
-    def _tokenize(self, text: str) -> List[str]:
-        """Simple tokenization."""
-        text = text.lower()
-        # Remove punctuation, keep alphanumeric and spaces
-        text = re.sub(r"[^\w\s]", " ", text)
-        tokens = text.split()
-        return [t for t in tokens if len(t) > 2]  # Filter very short tokens
+    def embed(self, text: str) -> np.ndarray:
+        """Dense L2-normalized TF-IDF vector for text, over the fitted vocabulary."""
+        if not self.chunks:
+            return np.zeros(0, dtype=np.float32)
+        return self.vectorizer.transform([text]).toarray().ravel()
     
-    def _build_index(self):
-        """Build TF-IDF index."""
-        # Build vocabulary
-        all_tokens = set()
-        chunk_tokens = []
-        
-        for chunk in self.chunks:
-            tokens = self._tokenize(chunk.content)
-            chunk_tokens.append(tokens)
-            all_tokens.update(tokens)
-        
-        self.vocab = {token: idx for idx, token in enumerate(sorted(all_tokens))}
-        
-        # Calculate IDF
-        num_chunks = len(self.chunks)
-        for token in self.vocab:
-            doc_freq = sum(1 for tokens in chunk_tokens if token in tokens)
-            self.idf[token] = math.log(num_chunks / (1 + doc_freq))
-        
-        # Build TF vectors for each chunk
-        for tokens in chunk_tokens:
-            tf = Counter(tokens)
-            max_tf = max(tf.values()) if tf else 1
-            
-            vector = {}
-            for token, count in tf.items():
-                if token in self.vocab:
-                    tf_score = count / max_tf
-                    vector[token] = tf_score * self.idf.get(token, 0)
-            
-            self.chunk_vectors.append(vector)
-    
-    def _cosine_similarity(self, vec1: Dict[str, float], vec2: Dict[str, float]) -> float:
-        """Calculate cosine similarity between two vectors."""
-        all_keys = set(vec1.keys()) | set(vec2.keys())
-        
-        dot_product = sum(vec1.get(k, 0) * vec2.get(k, 0) for k in all_keys)
-        
-        norm1 = math.sqrt(sum(v * v for v in vec1.values()))
-        norm2 = math.sqrt(sum(v * v for v in vec2.values()))
-        
-        if norm1 == 0 or norm2 == 0:
-            return 0.0
-        
-        return dot_product / (norm1 * norm2)
+    @staticmethod
+    def word_set(text: str) -> frozenset:
+        """Lowercased words of text, including the short ones the vectorizer skips."""
+        return frozenset(_WORD_RE.findall(text.lower()))
     
     def retrieve(self, query: str, top_k: int = 5) -> List[Chunk]:
         """
@@ -120,29 +164,28 @@ class TFIDFRetriever:
         
         Returns chunks sorted by relevance score.
         """
-        query_tokens = self._tokenize(query)
+        if not self.chunks or top_k <= 0:
+            return []
         
-        # Build query vector
-        query_tf = Counter(query_tokens)
-        max_tf = max(query_tf.values()) if query_tf else 1
+        # Rows are L2-normalized, so the dot product is the cosine similarity
+        q = self.vectorizer.transform([query])
+        if self.X_dense is not None:
+            sims = self.X_dense @ q.toarray().ravel()
+        else:
+            sims = (self.X @ q.T).toarray().ravel()
         
-        query_vector = {}
-        for token, count in query_tf.items():
-            if token in self.vocab:
-                tf_score = count / max_tf
-                query_vector[token] = tf_score * self.idf.get(token, 0)
+        # Select top-k without sorting the whole score vector
+        top_k = min(top_k, len(sims))
+        if top_k < len(sims):
+            idx = np.argpartition(-sims, top_k)[:top_k]
+        else:
+            idx = np.arange(len(sims))
+        idx = idx[np.argsort(-sims[idx], kind="stable")]
         
-        # Calculate similarity scores
-        scored_chunks = []
-        for idx, chunk_vector in enumerate(self.chunk_vectors):
-            score = self._cosine_similarity(query_vector, chunk_vector)
-            chunk = self.chunks[idx]
-            chunk.score = score
-            scored_chunks.append((score, chunk))
-        
-        # Sort by score descending
-        scored_chunks.sort(key=lambda x: x[0], reverse=True)
-        
-        # Return top-k
-        return [chunk for _, chunk in scored_chunks[:top_k]]
-
+        # Score copies so concurrent queries never race on shared chunks
+        results = []
+        for i in idx:
+            chunk = copy.copy(self.chunks[i])
+            chunk.score = float(sims[i])
+            results.append(chunk)
+        return results
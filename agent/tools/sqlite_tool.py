@@ -1,46 +1,248 @@
 """SQLite tool for database access and schema introspection."""
+import functools
+import re
 import sqlite3
-from typing import Dict, List, Tuple, Any, Optional
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Tuple, Any, Optional
 from pathlib import Path
 
+# Optional columnar results for execute_arrow: ADBC's SQLite driver reads
+# straight into Arrow; pyarrow alone converts sqlite3 rows
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+try:
+    import adbc_driver_sqlite.dbapi as adbc_sqlite
+except ImportError:
+    adbc_sqlite = None
+
+
+# Set once by setup_db: WAL lets reads proceed during writes (and adds -wal/-shm
+# sidecar files next to the database). It persists in the file, so connections
+# don't re-issue it (and a read-only database can't switch modes anyway).
+SQLITE_JOURNAL_MODE = "journal_mode=WAL"
+
+# Applied best-effort to every connection: trade durability on power loss for
+# speed and keep more pages in memory (64 MB page cache, 256 MB memory-mapped I/O).
+SQLITE_PRAGMAS = (
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "cache_size=-64000",
+    "mmap_size=268435456",
+)
+
+# Lowercase compatibility views over the Northwind tables: (view, table)
+COMPAT_VIEWS = (
+    ("orders", "Orders"),
+    ("order_items", '"Order Details"'),
+    ("products", "Products"),
+    ("customers", "Customers"),
+)
+
+
+def compat_view_ddl(view_name: str, table_name: str) -> str:
+    return f"CREATE VIEW IF NOT EXISTS {view_name} AS SELECT * FROM {table_name};"
+
+
+# All compatibility views in one transaction (a single commit, not one per view)
+COMPAT_VIEWS_SCRIPT = "BEGIN;\n" + "\n".join(
+    compat_view_ddl(view_name, table_name) for view_name, table_name in COMPAT_VIEWS
+) + "\nCOMMIT;"
+
+# Rows pulled from the cursor per fetchmany() call when streaming
+FETCH_BATCH_SIZE = 1000
+
+# Per-connection prepared statement cache (sqlite3 defaults to 128)
+CACHED_STATEMENTS = 256
+
+# Literals, quoted identifiers ("...", [...], `...`) and comments are kept
+# verbatim; any other whitespace run is collapsed (to a newline if it spans
+# one, so a trailing -- comment never swallows the next line)
+_SQL_TOKEN = re.compile(
+    r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|\[[^\]]*\]|`(?:[^`]|``)*`|--[^\n]*|/\*.*?\*/)|(\s*\n\s*)|\s+""",
+    re.DOTALL,
+)
+
+
+@functools.lru_cache(maxsize=CACHED_STATEMENTS)
+def _normalize_sql(query: str) -> str:
+    """Canonical text for a query, so whitespace variants share one prepared statement."""
+    def sub(m: re.Match) -> str:
+        if m.group(1):
+            return m.group(1)
+        return "\n" if m.group(2) else " "
+    return _SQL_TOKEN.sub(sub, query).strip()
+
+
+def rows_as_dicts(rows: List[tuple], columns: List[str]) -> List[Dict[str, Any]]:
+    """Materialize tuple rows from SQLiteTool.execute as dicts keyed by column."""
+    columns = tuple(columns)  # Hoisted once; zip walks it for every row
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def _is_select(query: str) -> bool:
+    """Whether the first keyword is SELECT, without upper-casing the whole query."""
+    i = 0
+    n = len(query)
+    while i < n and query[i] in " \t\r\n":
+        i += 1
+    return query[i:i + 6].lower() == "select"
+
+
+def _arrow_column(values: tuple) -> "pa.Array":
+    """Arrow array for one result column; mixed-type columns become strings."""
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # SQLite columns are dynamically typed; match ADBC, which reads these as text
+        return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
 
 class SQLiteTool:
     """Tool for executing SQL queries and introspecting schema."""
     
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, result_cache_size: int = 0, result_cache_max_rows: int = 200):
+        """
+        Args:
+            db_path: Path to the SQLite database
+            result_cache_size: SELECT results to keep, keyed by normalized SQL
+                (0 disables). Writes through this tool and schema changes clear
+                it; writes by other processes are not seen, so enable it only
+                for a database that is read-only in practice.
+            result_cache_max_rows: Results with more rows than this are never
+                cached, bounding the cache to size * max_rows rows
+        """
         self.db_path = Path(db_path)
         if not self.db_path.exists():
             raise FileNotFoundError(f"Database not found: {db_path}")
+        self._local = threading.local()
+        # Every live per-thread connection (sqlite3, and ADBC for
+        # execute_arrow), so close() can release them all; a thread's
+        # connections are closed and dropped when the thread exits
+        self._connections: List[Any] = []
+        self._connections_lock = threading.Lock()
+        # Serializes writes across this tool's threads (reads run concurrently)
+        self._write_lock = threading.Lock()
+        # Schema caches, populated on first access and dropped when
+        # PRAGMA schema_version moves (see _sync_schema_version)
+        self._schema_version = -1
+        self._schema_cache: Optional[Dict[str, List[Dict[str, str]]]] = None
+        self._schema_str_cache: Optional[str] = None
+        self._tables_cache: Optional[List[str]] = None
+        self._tables_lower: List[str] = []
+        self._tables_re: Optional[re.Pattern] = None
+        self._tables_by_lower: Dict[str, str] = {}
+        # LRU of normalized SELECT -> (rows, columns)
+        self._result_cache_size = result_cache_size
+        self._result_cache_max_rows = result_cache_max_rows
+        self._result_cache: "OrderedDict[str, Tuple[List[tuple], List[str]]]" = OrderedDict()
+        self._result_cache_lock = threading.Lock()
+        # Bumped by every clear, so a SELECT that overlapped one doesn't store
+        self._result_cache_generation = 0
         self._ensure_lowercase_views()
     
+    def _conn(self) -> sqlite3.Connection:
+        """Get this thread's long-lived connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                check_same_thread=False,
+                isolation_level=None,
+                cached_statements=CACHED_STATEMENTS,
+            )
+            for pragma in SQLITE_PRAGMAS:
+                try:
+                    conn.execute(f"PRAGMA {pragma};")
+                except sqlite3.OperationalError:
+                    # Tuning only; e.g. a read-only or locked database
+                    pass
+            self._local.conn = conn
+            self._track(conn)
+        return conn
+    
+    def _adbc_conn(self) -> "adbc_sqlite.Connection":
+        """Get this thread's long-lived ADBC connection for execute_arrow."""
+        conn = getattr(self._local, "adbc_conn", None)
+        if conn is None:
+            # Autocommit, so reads never sit in a transaction that would pin
+            # an old snapshot of the database
+            conn = adbc_sqlite.connect(str(self.db_path), autocommit=True)
+            with conn.cursor() as cursor:
+                for pragma in SQLITE_PRAGMAS:
+                    try:
+                        cursor.execute(f"PRAGMA {pragma};")
+                    except adbc_sqlite.Error:
+                        pass
+            self._local.adbc_conn = conn
+            self._track(conn)
+        return conn
+    
+    def _track(self, conn: Any):
+        """Register a new per-thread connection for close() and thread-exit cleanup."""
+        with self._connections_lock:
+            self._connections.append(conn)
+        # Short-lived executor threads (e.g. one pool per asyncio.run)
+        # would otherwise leave their connections open until close()
+        weakref.finalize(
+            threading.current_thread(),
+            self._release,
+            self._connections,
+            self._connections_lock,
+            conn,
+        )
+    
+    @staticmethod
+    def _release(connections: List[Any], lock: threading.Lock, conn: Any):
+        """Close a finished thread's connection and forget it."""
+        with lock:
+            if conn in connections:
+                connections.remove(conn)
+        conn.close()
+    
+    def close(self):
+        """Close all connections; the next call opens fresh ones."""
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+            self._local = threading.local()
+    
+    def __enter__(self) -> "SQLiteTool":
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+    
+    def __del__(self):
+        # May run on a partially initialized instance or at interpreter exit
+        if getattr(self, "_connections", None):
+            self.close()
+    
     def _ensure_lowercase_views(self):
         """Create lowercase compatibility views if they don't exist."""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            cursor = self._conn().cursor()
             
             # Test if database is valid
             cursor.execute("SELECT name FROM sqlite_master WHERE type='table' LIMIT 1;")
             cursor.fetchone()
             
-            views = [
-                ("orders", "Orders"),
-                ("order_items", '"Order Details"'),
-                ("products", "Products"),
-                ("customers", "Customers"),
-            ]
-            
-            for view_name, table_name in views:
-                try:
-                    cursor.execute(
-                        f"CREATE VIEW IF NOT EXISTS {view_name} AS SELECT * FROM {table_name};"
-                    )
-                except sqlite3.OperationalError as e:
-                    # View might already exist or table doesn't exist, skip
-                    pass
-            
-            conn.commit()
-            conn.close()
+            try:
+                cursor.executescript(COMPAT_VIEWS_SCRIPT)
+            except sqlite3.OperationalError:
+                # A table is missing; create the views that can be created
+                if self._conn().in_transaction:
+                    cursor.execute("ROLLBACK;")
+                for view_name, table_name in COMPAT_VIEWS:
+                    try:
+                        cursor.execute(compat_view_ddl(view_name, table_name))
+                    except sqlite3.OperationalError as e:
+                        # View might already exist or table doesn't exist, skip
+                        pass
         except sqlite3.DatabaseError as e:
             raise FileNotFoundError(
                 f"Database is corrupted or invalid: {e}. "
@@ -49,90 +251,223 @@ class SQLiteTool:
     
     def get_schema(self) -> Dict[str, List[Dict[str, str]]]:
         """Get database schema information."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        self._sync_schema_version()
+        if self._schema_cache is not None:
+            return self._schema_cache
         
-        schema = {}
+        cursor = self._conn().cursor()
         
-        # Get all tables
+        # Columns of every table in one statement rather than a
+        # PRAGMA table_info round trip per table
         cursor.execute(
-            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';"
+            """
+            SELECT m.name, p.name, p.type, p."notnull", p.dflt_value, p.pk
+            FROM sqlite_master m
+            JOIN pragma_table_info(m.name) p
+            WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%'
+            ORDER BY m.rowid, p.cid;
+            """
         )
-        tables = [row[0] for row in cursor.fetchall()]
         
-        for table in tables:
-            # Quote table name to handle spaces and special characters
-            # SQLite requires double quotes for identifiers with spaces
-            # Always quote to be safe
-            quoted_table = f'"{table}"'
-            cursor.execute(f"PRAGMA table_info({quoted_table})")
-            columns = cursor.fetchall()
-            schema[table] = [
+        schema = {}
+        for table, name, col_type, notnull, default, pk in cursor.fetchall():
+            schema.setdefault(table, []).append(
                 {
-                    "name": col[1],
-                    "type": col[2],
-                    "notnull": bool(col[3]),
-                    "default": col[4],
-                    "pk": bool(col[5]),
+                    "name": name,
+                    "type": col_type,
+                    "notnull": bool(notnull),
+                    "default": default,
+                    "pk": bool(pk),
                 }
-                for col in columns
-            ]
+            )
         
-        conn.close()
+        self._schema_cache = schema
         return schema
     
     def get_schema_string(self) -> str:
         """Get schema as a formatted string for prompts."""
-        schema = self.get_schema()
-        lines = ["Database Schema:"]
+        self._sync_schema_version()
+        if self._schema_str_cache is not None:
+            return self._schema_str_cache
         
+        schema = self.get_schema()
+        parts = ["Database Schema:"]
         for table, columns in schema.items():
-            lines.append(f"\n{table}:")
-            for col in columns:
-                pk_str = " (PRIMARY KEY)" if col["pk"] else ""
-                notnull_str = " NOT NULL" if col["notnull"] else ""
-                lines.append(f"  - {col['name']}: {col['type']}{pk_str}{notnull_str}")
+            parts.append(f"\n{table}:")
+            parts.extend(
+                f"  - {col['name']}: {col['type']}"
+                f"{' (PRIMARY KEY)' if col['pk'] else ''}"
+                f"{' NOT NULL' if col['notnull'] else ''}"
+                for col in columns
+            )
         
-        return "\n".join(lines)
+        self._schema_str_cache = "\n".join(parts)
+        return self._schema_str_cache
     
-    def execute(self, query: str) -> Tuple[Optional[List[Dict[str, Any]]], Optional[str], List[str]]:
+    def execute(self, query: str) -> Tuple[Optional[List[tuple]], Optional[str], List[str]]:
         """
         Execute SQL query.
         
         Returns:
-            (rows, error, columns): rows as list of dicts, error message if any, column names
+            (rows, error, columns): rows as list of tuples, error message if any, column names
+        
+        Use rows_as_dicts(rows, columns) where dict rows are needed.
         """
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = self._conn().cursor()
+        # sqlite3 reuses a prepared statement when the SQL text matches
+        # exactly, so normalize first to make retried queries hit it
+        query = _normalize_sql(query)
+        is_select = _is_select(query)
         
         try:
-            cursor.execute(query)
-            
-            if query.strip().upper().startswith("SELECT"):
+            if is_select:
+                if self._result_cache_size:
+                    self._sync_schema_version()
+                    with self._result_cache_lock:
+                        cached = self._result_cache.get(query)
+                        if cached is not None:
+                            self._result_cache.move_to_end(query)
+                            # Copies, so callers can't alter the cached result
+                            return list(cached[0]), None, list(cached[1])
+                        generation = self._result_cache_generation
+                
+                cursor.execute(query)
                 rows = cursor.fetchall()
                 columns = [desc[0] for desc in cursor.description] if cursor.description else []
-                result = [dict(row) for row in rows]
-                conn.close()
-                return result, None, columns
+                
+                if self._result_cache_size and len(rows) <= self._result_cache_max_rows:
+                    with self._result_cache_lock:
+                        # A write cleared the cache while this ran, so the
+                        # rows may predate it; return them but don't keep them
+                        if generation == self._result_cache_generation:
+                            self._result_cache[query] = (list(rows), list(columns))
+                            if len(self._result_cache) > self._result_cache_size:
+                                self._result_cache.popitem(last=False)
+                return rows, None, columns
             else:
-                conn.commit()
-                conn.close()
+                with self._write_lock:
+                    try:
+                        cursor.execute(query)
+                    finally:
+                        # After the write, so no SELECT can re-cache pre-write rows
+                        self.clear_result_cache()
                 return None, None, []
         
         except sqlite3.Error as e:
             error_msg = str(e)
-            conn.close()
             return None, error_msg, []
     
+    def execute_arrow(self, query: str) -> Tuple[Optional[Any], Optional[str], List[str]]:
+        """
+        Execute a SELECT and return its result in columnar form.
+        
+        Returns:
+            (table, error, columns): a pyarrow.Table, or a list of dicts when
+            pyarrow isn't installed; error message if any; column names
+        """
+        if pa is None or not _is_select(query):
+            # Writes always go through execute() and its write lock
+            rows, error, columns = self.execute(query)
+            return (rows_as_dicts(rows, columns) if rows is not None else None), error, columns
+        
+        if adbc_sqlite is not None:
+            try:
+                with self._adbc_conn().cursor() as cursor:
+                    cursor.execute(_normalize_sql(query))
+                    table = cursor.fetch_arrow_table()
+                return table, None, table.column_names
+            except adbc_sqlite.Error as e:
+                return None, str(e), []
+        
+        rows, error, columns = self.execute(query)
+        if rows is None:
+            return None, error, columns
+        if not rows:
+            arrays = [pa.nulls(0) for _ in columns]
+        else:
+            arrays = [_arrow_column(values) for values in zip(*rows)]
+        return pa.Table.from_arrays(arrays, names=columns), None, columns
+    
+    def execute_iter(self, query: str) -> Iterator[Dict[str, Any]]:
+        """
+        Execute a SELECT and stream its rows as dicts keyed by column.
+        
+        Rows are fetched FETCH_BATCH_SIZE at a time, so large results are
+        never fully materialized. The query runs on the call, not on first
+        iteration: raises ValueError for anything but a SELECT (writes go
+        through execute() and its write lock) and sqlite3.Error on failure.
+        """
+        query = _normalize_sql(query)
+        if not _is_select(query):
+            raise ValueError("execute_iter only runs SELECT queries; use execute() for writes")
+        cursor = self._conn().cursor()
+        cursor.execute(query)
+        columns = tuple(desc[0] for desc in cursor.description) if cursor.description else ()
+        return self._iter_rows(cursor, columns)
+    
+    @staticmethod
+    def _iter_rows(cursor: sqlite3.Cursor, columns: Tuple[str, ...]) -> Iterator[Dict[str, Any]]:
+        while True:
+            batch = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not batch:
+                break
+            for row in batch:
+                yield dict(zip(columns, row))
+    
     def get_table_names(self) -> List[str]:
         """Get list of all table names."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';"
-        )
-        tables = [row[0] for row in cursor.fetchall()]
-        conn.close()
-        return tables
+        self._sync_schema_version()
+        if self._tables_cache is None:
+            cursor = self._conn().cursor()
+            cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';"
+            )
+            self._tables_cache = [row[0] for row in cursor.fetchall()]
+            self._tables_lower = [t.lower() for t in self._tables_cache]
+        return list(self._tables_cache)
+    
+    @property
+    def tables_with_lower(self) -> List[Tuple[str, str]]:
+        """(table_name, lowercased_name) pairs for case-insensitive matching."""
+        self.get_table_names()
+        return list(zip(self._tables_cache, self._tables_lower))
+    
+    def tables_in_query(self, query: str) -> List[str]:
+        """Table names referenced in a query, in order of first appearance."""
+        self._sync_schema_version()
+        if self._tables_re is None:
+            self._tables_by_lower = {lower: table for table, lower in self.tables_with_lower}
+            if not self._tables_by_lower:
+                return []
+            # Longest names first so e.g. "order details" wins over a prefix
+            names = sorted(self._tables_by_lower, key=len, reverse=True)
+            self._tables_re = re.compile(r"\b(" + "|".join(map(re.escape, names)) + r")\b")
+        
+        matches = self._tables_re.findall(query.lower())
+        return [self._tables_by_lower[m] for m in dict.fromkeys(matches)]
+    
+    def _sync_schema_version(self):
+        """Drop cached schema if the database schema changed since it was read."""
+        # SQLite bumps schema_version on every DDL change, so one PRAGMA
+        # tells whether the cached schema is still valid (the same scheme
+        # datasette-graphql uses to cache its schema)
+        version = self._conn().execute("PRAGMA schema_version").fetchone()[0]
+        if version != self._schema_version:
+            self.refresh_schema()
+            self._schema_version = version
+    
+    def clear_result_cache(self):
+        """Drop cached SELECT results, including any still being read."""
+        with self._result_cache_lock:
+            self._result_cache.clear()
+            self._result_cache_generation += 1
+    
+    def refresh_schema(self):
+        """Drop cached schema so the next access re-reads it from the database."""
+        self._schema_cache = None
+        self._schema_str_cache = None
+        self._tables_cache = None
+        self._tables_lower = []
+        self._tables_re = None
+        self.clear_result_cache()
 
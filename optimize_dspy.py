@@ -1,12 +1,12 @@
 """Script to optimize DSPy modules (for demonstration)."""
 import dspy
 from agent.dspy_signatures import NLToSQL
+from agent.graph_hybrid import build_ollama_lm
 from agent.tools.sqlite_tool import SQLiteTool
 
 
-def create_training_set():
+def create_training_set(db_tool: SQLiteTool):
     """Create a small training set for optimization."""
-    db_tool = SQLiteTool("data/northwind.sqlite")
     schema = db_tool.get_schema_string()
     
     # Handcrafted examples
@@ -50,17 +50,17 @@ def optimize_nl_to_sql():
     """Optimize the NL→SQL module."""
     print("Setting up LLM...")
     try:
-        # Use full model name that matches what was pulled
-        lm = dspy.LM(model="ollama/phi3.5:3.8b-mini-instruct-q4_K_M", api_base="http://localhost:11434")
-        dspy.configure(lm=lm)
+        dspy.configure(lm=build_ollama_lm())
     except Exception as e:
         print(f"Error: {e}")
         print("Make sure Ollama is running and phi3.5 model is installed!")
         print("Run: ollama pull phi3.5:3.8b-mini-instruct-q4_K_M")
         return
     
+    db_tool = SQLiteTool("data/northwind.sqlite")
+    
     print("Creating training set...")
-    train_examples = create_training_set()
+    train_examples = create_training_set(db_tool)
     
     print("Initializing module...")
     module = NLToSQL()
@@ -68,7 +68,7 @@ def optimize_nl_to_sql():
     # Test before optimization
     print("\n=== BEFORE OPTIMIZATION ===")
     test_question = "Top 3 products by revenue"
-    schema = SQLiteTool("data/northwind.sqlite").get_schema_string()
+    schema = db_tool.get_schema_string()
     
     try:
         sql_before = module(question=test_question, schema=schema, context="")
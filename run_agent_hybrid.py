@@ -1,30 +1,51 @@
 """Main entrypoint for the retail analytics copilot."""
+import asyncio
 import click
 import json
+import orjson
 import sys
+import time
 from pathlib import Path
-import dspy
+from typing import Any, Dict, Iterator
 from rich.console import Console
 from rich.progress import Progress
 
-from agent.graph_hybrid import HybridAgent
+from agent.graph_hybrid import HybridAgent, OLLAMA_MODEL, build_ollama_lm
 
 
 console = Console()
 
+# Touched after a successful Ollama test call; the test is skipped while it is fresh
+OLLAMA_OK_MARKER = Path.home() / ".retail_copilot" / "ollama_ok"
+OLLAMA_OK_TTL = 300  # seconds
+
 
 def setup_llm():
     """Setup DSPy LM with Ollama."""
     try:
-        # Use the full model name that matches what you pulled
         # When you pull: ollama pull phi3.5:3.8b-mini-instruct-q4_K_M
         # The model name must match exactly: phi3.5:3.8b-mini-instruct-q4_K_M
-        model_name = "phi3.5:3.8b-mini-instruct-q4_K_M"
-        lm = dspy.LM(model=f"ollama/{model_name}", api_base="http://localhost:11434")
+        model_name = OLLAMA_MODEL
+        lm = build_ollama_lm(model_name)
+        
+        try:
+            verified_recently = time.time() - OLLAMA_OK_MARKER.stat().st_mtime < OLLAMA_OK_TTL
+        except OSError:
+            verified_recently = False
+        if verified_recently:
+            console.print("[yellow]Skipping Ollama connection test (verified in the last few minutes)[/yellow]")
+            return lm
+        
         # Test connection
         console.print("[cyan]Testing Ollama connection...[/cyan]")
-        test_response = lm("test", max_tokens=1)
+        # Bypass the response cache, or a cached reply would mask a dead server
+        test_response = lm("test", max_tokens=1, cache=False)
         console.print("[green]✓ Ollama connection successful[/green]")
+        try:
+            OLLAMA_OK_MARKER.parent.mkdir(parents=True, exist_ok=True)
+            OLLAMA_OK_MARKER.touch()
+        except OSError:
+            pass  # Only means the next run tests again
         return lm
     except Exception as e:
         console.print(f"[red]Error connecting to Ollama: {e}[/red]")
@@ -36,10 +57,29 @@ def setup_llm():
         sys.exit(1)
 
 
+def iter_questions(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield questions from a JSONL file one line at a time."""
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
+
+
+def dumps_line(result: Dict[str, Any]) -> bytes:
+    """Serialize a result as one JSONL line."""
+    try:
+        return orjson.dumps(result, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    except TypeError:
+        # e.g. integers beyond 64 bits, which the stdlib still handles
+        return (json.dumps(result) + "\n").encode()
+
+
 @click.command()
 @click.option("--batch", required=True, type=click.Path(exists=True), help="Input JSONL file with questions")
 @click.option("--out", required=True, type=click.Path(), help="Output JSONL file")
-def main(batch: str, out: str):
+@click.option("--workers", default=8, show_default=True, type=click.IntRange(min=1), help="Questions processed concurrently by the agent graph")
+@click.option("--quiet/--verbose", default=False, help="Only report progress and errors (no per-answer output or tracebacks)")
+def main(batch: str, out: str, workers: int, quiet: bool):
     """Run the retail analytics copilot on a batch of questions."""
     
     # Setup paths
@@ -79,63 +119,68 @@ def main(batch: str, out: str):
         llm=lm,
     )
     
-    # Load questions
-    questions = []
-    with open(batch, "r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip():
-                questions.append(json.loads(line))
+    def to_output(q: Dict[str, Any], result: Any) -> Dict[str, Any]:
+        """Output line for a question; a failed question becomes an error result."""
+        question_id = q["id"]
+        if isinstance(result, Exception):
+            console.print(f"[red]Error processing {question_id}: {result}[/red]")
+            if not quiet:
+                import traceback
+                traceback.print_exception(type(result), result, result.__traceback__)
+            
+            return {
+                "id": question_id,
+                "final_answer": None,
+                "sql": "",
+                "confidence": 0.0,
+                "explanation": f"Error: {str(result)}",
+                "citations": [],
+            }
+        return {
+            "id": question_id,
+            "final_answer": result["final_answer"],
+            "sql": result.get("sql", ""),
+            "confidence": result["confidence"],
+            "explanation": result["explanation"],
+            "citations": result["citations"],
+        }
     
+    # Parsed line by line, but kept as a list: the graph's batch API takes a
+    # sequence of inputs, results come back by index and the progress bar
+    # needs the total. Question records are small next to the agent's state.
+    questions = list(iter_questions(batch))
     console.print(f"[green]Loaded {len(questions)} questions[/green]")
     
-    # Process questions
-    results = []
-    with Progress() as progress:
-        task = progress.add_task("[cyan]Processing questions...", total=len(questions))
-        
-        for q in questions:
-            question_id = q["id"]
-            question = q["question"]
-            format_hint = q.get("format_hint", "str")
-            
-            console.print(f"\n[bold]Processing: {question_id}[/bold]")
-            console.print(f"Question: {question}")
+    async def process_all(f, progress: Progress, task):
+        # One event loop for the whole batch; the graph runs up to `workers`
+        # questions at once, each mostly waiting on Ollama. Lines are written
+        # as soon as every earlier question is done, so the file keeps input
+        # order and only out-of-order results are held back.
+        pending: Dict[int, Dict[str, Any]] = {}
+        next_idx = 0
+        async for idx, result in agent.arun_as_completed(
+            [q["question"] for q in questions],
+            [q.get("format_hint", "str") for q in questions],
+            max_concurrency=workers,
+            return_exceptions=True,
+        ):
+            output = to_output(questions[idx], result)
+            pending[idx] = output
+            if quiet:
+                progress.update(task, advance=1, description=f"[cyan]{output['id']}")
+            else:
+                if output["final_answer"] is not None:
+                    console.print(f"[green]✓ {output['id']}: {output['final_answer']}[/green]")
+                progress.update(task, advance=1)
             
-            try:
-                result = agent.run(question, format_hint)
-                
-                output = {
-                    "id": question_id,
-                    "final_answer": result["final_answer"],
-                    "sql": result.get("sql", ""),
-                    "confidence": result["confidence"],
-                    "explanation": result["explanation"],
-                    "citations": result["citations"],
-                }
-                
-                results.append(output)
-                console.print(f"[green]✓ Answer: {result['final_answer']}[/green]")
-                
-            except Exception as e:
-                console.print(f"[red]Error processing {question_id}: {e}[/red]")
-                import traceback
-                traceback.print_exc()
-                
-                results.append({
-                    "id": question_id,
-                    "final_answer": None,
-                    "sql": "",
-                    "confidence": 0.0,
-                    "explanation": f"Error: {str(e)}",
-                    "citations": [],
-                })
-            
-            progress.update(task, advance=1)
+            while next_idx in pending:
+                f.write(dumps_line(pending.pop(next_idx)))
+                next_idx += 1
+            f.flush()
     
-    # Write results
-    with open(out, "w", encoding="utf-8") as f:
-        for result in results:
-            f.write(json.dumps(result) + "\n")
+    with open(out, "wb") as f, Progress() as progress:
+        task = progress.add_task("[cyan]Processing questions...", total=len(questions))
+        asyncio.run(process_all(f, progress, task))
     
     console.print(f"\n[green]✓ Results written to {out}[/green]")
 
@@ -1,8 +1,57 @@
 """Setup script to download Northwind database and create views."""
+import hashlib
+import os
 import urllib.request
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from agent.tools.sqlite_tool import (
+    COMPAT_VIEWS,
+    COMPAT_VIEWS_SCRIPT,
+    SQLITE_JOURNAL_MODE,
+    SQLITE_PRAGMAS,
+    compat_view_ddl,
+)
+
+DB_URL = "https://raw.githubusercontent.com/jpwhite3/northwind-SQLite3/main/dist/northwind.db"
+# No digest is pinned: DB_URL follows a branch, so the file can change
+# upstream. Set NORTHWIND_SHA256 to a hex digest to enforce one; otherwise
+# only the size and SQLite header checks apply.
+EXPECTED_SHA256 = os.environ.get("NORTHWIND_SHA256") or None
+SQLITE_HEADER = b"SQLite format 3\x00"
+# Read/write buffer for the download stream
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+
+def _fetch(url: str, dest: Path) -> str:
+    """Stream url into dest through a .part file; returns its SHA-256 hex digest."""
+    tmp = dest.with_name(dest.name + ".part")
+    digest = hashlib.sha256()
+    try:
+        with urllib.request.urlopen(url) as resp, open(tmp, "wb") as f:
+            while True:
+                chunk = resp.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+        
+        if tmp.stat().st_size <= 1000000:  # At least 1MB
+            raise Exception("Downloaded file is too small")
+        with open(tmp, "rb") as f:
+            if f.read(len(SQLITE_HEADER)) != SQLITE_HEADER:
+                raise Exception("Downloaded file is not an SQLite database")
+        if EXPECTED_SHA256 and digest.hexdigest() != EXPECTED_SHA256.lower():
+            raise Exception(f"Checksum mismatch: got {digest.hexdigest()}")
+        
+        # Only a fully downloaded file that passed the checks appears at dest
+        os.replace(tmp, dest)
+    finally:
+        if tmp.exists():
+            tmp.unlink()  # Remove partial download
+    return digest.hexdigest()
+
 
 def download_database(force_redownload=False):
     """Download Northwind database."""
@@ -25,24 +74,18 @@ def download_database(force_redownload=False):
             db_path.unlink()  # Delete corrupted file
     
     print("Downloading Northwind database...")
-    url = "https://raw.githubusercontent.com/jpwhite3/northwind-SQLite3/main/dist/northwind.db"
+    url = DB_URL
     
     try:
         print("This may take a few minutes...")
-        urllib.request.urlretrieve(url, db_path)
-        
-        # Verify download
-        if db_path.exists() and db_path.stat().st_size > 1000000:  # At least 1MB
-            print(f"✓ Database downloaded to {db_path} ({db_path.stat().st_size / 1024 / 1024:.2f} MB)")
-        else:
-            raise Exception("Downloaded file is too small or missing")
+        sha256 = _fetch(url, db_path)
+        print(f"✓ Database downloaded to {db_path} ({db_path.stat().st_size / 1024 / 1024:.2f} MB)")
+        print(f"  sha256: {sha256} ({'matches NORTHWIND_SHA256' if EXPECTED_SHA256 else 'not checked'})")
             
     except Exception as e:
         print(f"Error downloading database: {e}")
         print("Please download manually from:")
         print(url)
-        if db_path.exists():
-            db_path.unlink()  # Remove partial download
         return None
     
     return str(db_path)
@@ -54,28 +97,37 @@ def create_views(db_path: str):
     
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
+    for pragma in (SQLITE_JOURNAL_MODE, *SQLITE_PRAGMAS):
+        cursor.execute(f"PRAGMA {pragma};")
     
-    views = [
-        ("orders", "Orders"),
-        ("order_items", '"Order Details"'),
-        ("products", "Products"),
-        ("customers", "Customers"),
-    ]
-    
-    for view_name, table_name in views:
-        try:
-            cursor.execute(
-                f"CREATE VIEW IF NOT EXISTS {view_name} AS SELECT * FROM {table_name};"
-            )
+    try:
+        cursor.executescript(COMPAT_VIEWS_SCRIPT)
+        for view_name, _ in COMPAT_VIEWS:
             print(f"✓ Created view: {view_name}")
-        except Exception as e:
-            print(f"Error creating view {view_name}: {e}")
+    except sqlite3.OperationalError as e:
+        print(f"Batch view creation failed ({e}), creating views one by one")
+        if conn.in_transaction:
+            conn.rollback()
+        for view_name, table_name in COMPAT_VIEWS:
+            try:
+                cursor.execute(compat_view_ddl(view_name, table_name))
+                print(f"✓ Created view: {view_name}")
+            except Exception as e:
+                print(f"Error creating view {view_name}: {e}")
     
     conn.commit()
     conn.close()
     print("✓ Views created")
 
 
+def build_doc_index(docs_dir: str = "docs"):
+    """Build and cache the TF-IDF index over the docs, so the first agent run can load it."""
+    from agent.rag.retrieval import TFIDFRetriever
+    
+    retriever = TFIDFRetriever(docs_dir)
+    print(f"✓ Document index ready ({len(retriever.chunks)} chunks)")
+
+
 if __name__ == "__main__":
     import sys
     
@@ -85,8 +137,15 @@ if __name__ == "__main__":
     # Check if force re-download is requested
     force = "--force" in sys.argv or "-f" in sys.argv
     
-    # Download database
-    db_path = download_database(force_redownload=force)
+    # Download the database in the background; the document index is
+    # built meanwhile since it doesn't depend on the database
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        download = executor.submit(download_database, force_redownload=force)
+        try:
+            build_doc_index()
+        except Exception as e:
+            print(f"Warning: could not build document index: {e}")
+        db_path = download.result()
     
     if db_path:
         # Create views
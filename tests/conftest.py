@@ -0,0 +1,62 @@
+"""Shared fixtures: a small Northwind-shaped database and the real docs."""
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+
+DOCS_DIR = Path(__file__).resolve().parent.parent / "docs"
+
+
+@pytest.fixture
+def db_path(tmp_path) -> str:
+    """A tiny database with the Northwind tables the agent queries."""
+    path = tmp_path / "northwind.sqlite"
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE Categories(CategoryID INTEGER PRIMARY KEY, CategoryName TEXT NOT NULL);
+        CREATE TABLE Products(ProductID INTEGER PRIMARY KEY, ProductName TEXT NOT NULL,
+                              CategoryID INTEGER, UnitPrice REAL DEFAULT 0);
+        CREATE TABLE Customers(CustomerID TEXT PRIMARY KEY, CompanyName TEXT);
+        CREATE TABLE Orders(OrderID INTEGER PRIMARY KEY, CustomerID TEXT, OrderDate TEXT);
+        CREATE TABLE "Order Details"(OrderID INTEGER, ProductID INTEGER, UnitPrice REAL,
+                                     Quantity INTEGER, Discount REAL);
+        INSERT INTO Categories VALUES (1, 'Beverages'), (2, 'Seafood');
+        INSERT INTO Products VALUES (1, 'Chai', 1, 18.0), (2, 'Ikura', 2, 31.0);
+        INSERT INTO Customers VALUES ('ALFKI', 'Alfreds'), ('BONAP', 'Bon app');
+        INSERT INTO Orders VALUES (1, 'ALFKI', '1997-01-05'), (2, 'BONAP', '1997-02-10');
+        INSERT INTO "Order Details" VALUES (1, 1, 18.0, 10, 0.0), (2, 2, 31.0, 5, 0.1);
+        """
+    )
+    conn.commit()
+    conn.close()
+    return str(path)
+
+
+@pytest.fixture
+def docs_dir() -> str:
+    return str(DOCS_DIR)
+
+
+@pytest.fixture
+def agent(db_path, docs_dir, monkeypatch):
+    """HybridAgent with its LLM-backed modules replaced by deterministic stand-ins.
+    
+    Questions containing "crash" make the router raise; the synthesizer
+    answers with the question text.
+    """
+    from agent.graph_hybrid import HybridAgent
+    
+    def route(question):
+        if "crash" in question:
+            raise RuntimeError("router crashed")
+        return "rag"
+    
+    monkeypatch.setenv("RAC_DISABLE_LLM_CACHE", "1")
+    hybrid = HybridAgent(db_path, docs_dir)
+    # The modules are shared across agents, so patch through monkeypatch
+    monkeypatch.setattr(hybrid.router, "forward", route)
+    monkeypatch.setattr(hybrid.nl_to_sql, "forward", lambda question, schema, context="": "SELECT 1")
+    monkeypatch.setattr(hybrid.synthesizer, "forward", lambda question, **kw: (question, [], "stub"))
+    return hybrid
@@ -0,0 +1,55 @@
+"""Tests for the ExactCache keys and bound."""
+import dspy
+import pytest
+from dspy.utils.dummies import DummyLM
+
+from agent import dspy_signatures
+from agent.dspy_signatures import ExactCache, NLToSQL
+
+
+@pytest.fixture
+def exact_cache(tmp_path, monkeypatch) -> ExactCache:
+    monkeypatch.delenv("RAC_DISABLE_LLM_CACHE", raising=False)
+    cache = ExactCache(tmp_path / "llm_exact.json")
+    monkeypatch.setattr(dspy_signatures, "_LLM_CACHE", cache)
+    return cache
+
+
+def _lm(sql: str) -> DummyLM:
+    return DummyLM([{"reasoning": "r", "sql_query": sql}] * 4)
+
+
+def test_switching_lm_misses(exact_cache):
+    module = NLToSQL()
+    with dspy.context(lm=_lm("SELECT 1")):
+        assert module("Rows?", "schema") == "SELECT 1"
+    with dspy.context(lm=_lm("SELECT 2")):
+        assert module("Rows?", "schema") == "SELECT 1"  # same LM setup, cached
+    other = _lm("SELECT 3")
+    other.kwargs["temperature"] = 0.7
+    with dspy.context(lm=other):
+        assert module("Rows?", "schema") == "SELECT 3"
+
+
+def test_setting_demos_misses(exact_cache):
+    module = NLToSQL()
+    with dspy.context(lm=_lm("SELECT 1")):
+        assert module("Rows?", "schema") == "SELECT 1"
+    module.generate.predict.demos = [
+        dspy.Example(question="q", db_schema="s", context="c", reasoning="r", sql_query="SELECT 9")
+    ]
+    with dspy.context(lm=_lm("SELECT 2")):
+        assert module("Rows?", "schema") == "SELECT 2"
+
+
+def test_keeps_newest_entries(tmp_path, monkeypatch):
+    monkeypatch.delenv("RAC_DISABLE_LLM_CACHE", raising=False)
+    cache = ExactCache(tmp_path / "llm_exact.json", max_entries=2)
+    for i in range(3):
+        cache.set(f"k{i}", i)
+    cache.set("k1", 1)  # re-setting refreshes the entry
+    cache.save()
+    reloaded = ExactCache(cache.path, max_entries=2)
+    assert reloaded.get("k0") is None
+    assert (reloaded.get("k2"), reloaded.get("k1")) == (2, 1)
+    assert list(reloaded._load()) == ["k2", "k1"]
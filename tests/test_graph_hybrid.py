@@ -0,0 +1,37 @@
+"""Tests for HybridAgent's run entry points."""
+import asyncio
+
+
+QUESTIONS = ["What is the return window for beverages?", "crash the router", "Summarize the KPI definitions."]
+
+
+def test_run_batch_keeps_input_order(agent):
+    ok = [QUESTIONS[0], QUESTIONS[2]]
+    results = agent.run_batch(ok, ["str"] * len(ok), max_concurrency=2)
+    assert [r["final_answer"] for r in results] == ok
+
+
+def test_as_completed_returns_exceptions_per_question(agent):
+    async def collect():
+        return {
+            idx: result
+            async for idx, result in agent.arun_as_completed(
+                QUESTIONS, ["str"] * len(QUESTIONS), max_concurrency=2, return_exceptions=True
+            )
+        }
+    
+    results = asyncio.run(collect())
+    assert sorted(results) == [0, 1, 2]
+    assert isinstance(results[1], RuntimeError)
+    assert results[0]["final_answer"] == QUESTIONS[0]
+    assert results[2]["final_answer"] == QUESTIONS[2]
+
+
+def test_run_inside_running_event_loop(agent):
+    async def caller():
+        # e.g. a Jupyter cell or an async app calling the sync API
+        return agent.run(QUESTIONS[0], "str"), agent.run_batch([QUESTIONS[2]], ["str"])
+    
+    single, batch = asyncio.run(caller())
+    assert single["final_answer"] == QUESTIONS[0]
+    assert batch[0]["final_answer"] == QUESTIONS[2]
@@ -0,0 +1,71 @@
+"""Tests for SemanticCache hits, misses and eviction."""
+import numpy as np
+import pytest
+
+from agent.cache.semantic import SemanticCache
+from agent.rag.retrieval import TFIDFRetriever
+
+
+# Pairs that embed identically over the docs vocabulary but need different answers
+DISTINCT_PAIRS = [
+    ("Which product had the highest gross margin?", "Which product had the lowest gross margin?"),
+    ("Top customer in Germany by revenue?", "Top customer in France by revenue?"),
+    ("Which customer had the highest gross margin?", "Which product had the lowest gross margin?"),
+    (
+        "Per the KPI definitions, what is the gross margin of Beverages in the Summer Beverages campaign?",
+        "Per the KPI definitions, what is the gross margin of Condiments in the Summer Condiments campaign?",
+    ),
+]
+
+
+@pytest.fixture
+def retriever(docs_dir, tmp_path) -> TFIDFRetriever:
+    return TFIDFRetriever(docs_dir, cache_dir=str(tmp_path))
+
+
+def _insert(cache, retriever, question, answer, format_hint="str"):
+    cache.insert(retriever.embed(question), answer, format_hint, retriever.word_set(question))
+
+
+def _lookup(cache, retriever, question, format_hint="str"):
+    return cache.lookup(retriever.embed(question), format_hint, retriever.word_set(question))
+
+
+@pytest.mark.parametrize("first, second", DISTINCT_PAIRS)
+def test_distinct_questions_miss(retriever, first, second):
+    cache = SemanticCache()
+    _insert(cache, retriever, first, {"final_answer": "first"})
+    assert _lookup(cache, retriever, second) is None
+
+
+def test_same_question_hits(retriever):
+    cache = SemanticCache()
+    question = "Which product had the highest gross margin?"
+    _insert(cache, retriever, question, {"final_answer": "first"})
+    assert _lookup(cache, retriever, question.upper())["final_answer"] == "first"
+    assert _lookup(cache, retriever, question, format_hint="int") is None
+
+
+def test_expired_and_excess_entries_evicted():
+    cache = SemanticCache(ttl=60, max_entries=3)
+    for i in range(5):
+        vec = np.zeros(8, dtype=np.float32)
+        vec[i] = 1.0
+        cache.insert(vec, {"final_answer": i})
+    assert len(cache) == 3
+    assert cache.M.shape[0] == 3
+    assert [a["final_answer"] for a in cache.answers] == [2, 3, 4]
+    
+    cache.ts[:] -= 120  # All entries are now past the TTL
+    vec = np.zeros(8, dtype=np.float32)
+    vec[7] = 1.0
+    cache.insert(vec, {"final_answer": 7})
+    assert len(cache) == 1
+
+
+@pytest.mark.parametrize("first, second", DISTINCT_PAIRS)
+def test_agent_does_not_serve_other_questions_answer(agent, first, second):
+    assert agent.run(first, "str")["final_answer"] == first
+    result = agent.run(second, "str")
+    assert result["trace"] != ["Semantic cache hit"]
+    assert result["final_answer"] == second
@@ -0,0 +1,149 @@
+"""Tests for SQLiteTool connection handling, caches and result streaming."""
+import asyncio
+import gc
+import sqlite3
+
+import pytest
+
+from agent.tools import sqlite_tool
+from agent.tools.sqlite_tool import COMPAT_VIEWS_SCRIPT, SQLiteTool
+
+
+def test_connections_released_when_threads_exit(db_path):
+    tool = SQLiteTool(db_path)
+    # Each asyncio.run gets a fresh default executor, i.e. fresh threads
+    for _ in range(50):
+        rows, error, _ = asyncio.run(asyncio.to_thread(tool.execute, "SELECT 1"))
+        assert error is None
+    gc.collect()
+    # Only the constructing thread's connection is left
+    assert len(tool._connections) == 1
+    tool.close()
+    assert tool._connections == []
+
+
+def test_result_cache_hits_and_row_limit(db_path):
+    tool = SQLiteTool(db_path, result_cache_size=8, result_cache_max_rows=1)
+    first = tool.execute("SELECT COUNT(*) FROM Orders")
+    assert tool.execute("SELECT   COUNT(*)   FROM Orders") == first
+    assert len(tool._result_cache) == 1
+    # Two rows exceed the limit, so the result is not kept
+    rows, error, _ = tool.execute('SELECT * FROM "Order Details"')
+    assert error is None and len(rows) == 2
+    assert len(tool._result_cache) == 1
+
+
+def test_result_cache_cleared_on_write(db_path):
+    tool = SQLiteTool(db_path, result_cache_size=8)
+    assert tool.execute("SELECT COUNT(*) FROM Orders")[0] == [(2,)]
+    tool.execute("DELETE FROM Orders WHERE OrderID = 1")
+    assert tool._result_cache == {}
+    assert tool.execute("SELECT COUNT(*) FROM Orders")[0] == [(1,)]
+
+
+def test_result_cache_skips_rows_read_during_a_write(db_path):
+    tool = SQLiteTool(db_path, result_cache_size=8)
+    # Stands in for another thread's write completing mid-SELECT
+    tool._conn().create_function("concurrent_write", 0, lambda: tool.clear_result_cache() or 1)
+    assert tool.execute("SELECT concurrent_write()")[0] == [(1,)]
+    assert tool._result_cache == {}
+    tool.execute("SELECT 1")
+    assert list(tool._result_cache) == ["SELECT 1"]
+
+
+def test_result_cache_cleared_on_schema_change(db_path):
+    tool = SQLiteTool(db_path, result_cache_size=8)
+    tool.execute("SELECT COUNT(*) FROM Orders")
+    # DDL from another connection bumps PRAGMA schema_version
+    other = SQLiteTool(db_path)
+    other.execute("CREATE TABLE Shippers(ShipperID INTEGER PRIMARY KEY)")
+    other.close()
+    tool.execute("SELECT 1")
+    assert list(tool._result_cache) == ["SELECT 1"]
+
+
+def test_read_only_database(db_path, monkeypatch):
+    # Views created, but left in rollback-journal mode: switching to WAL needs write access
+    conn = sqlite3.connect(db_path)
+    conn.executescript(COMPAT_VIEWS_SCRIPT)
+    conn.close()
+    connect = sqlite3.connect
+    # Opened read-only rather than chmod'ed, which doesn't stop root
+    monkeypatch.setattr(
+        sqlite3, "connect", lambda path, **kwargs: connect(f"file:{path}?mode=ro", uri=True, **kwargs)
+    )
+    tool = SQLiteTool(db_path)
+    assert tool.execute("SELECT COUNT(*) FROM orders")[:2] == ([(2,)], None)
+    rows, error, _ = tool.execute("DELETE FROM Orders")
+    assert rows is None and "readonly" in error
+
+
+def test_execute_iter_streams_dicts_across_batches(db_path, monkeypatch):
+    monkeypatch.setattr(sqlite_tool, "FETCH_BATCH_SIZE", 1)
+    tool = SQLiteTool(db_path)
+    rows = tool.execute_iter("SELECT OrderID, CustomerID FROM Orders ORDER BY OrderID")
+    assert next(rows) == {"OrderID": 1, "CustomerID": "ALFKI"}
+    assert list(rows) == [{"OrderID": 2, "CustomerID": "BONAP"}]
+
+
+def test_execute_iter_errors(db_path):
+    tool = SQLiteTool(db_path, result_cache_size=8)
+    with pytest.raises(sqlite3.OperationalError, match="no such table"):
+        tool.execute_iter("SELECT * FROM Missing")
+    tool.execute("SELECT COUNT(*) FROM Orders")
+    with pytest.raises(ValueError):
+        tool.execute_iter("DELETE FROM Orders")
+    # Nothing was written, so the cached count still holds
+    assert tool.execute("SELECT COUNT(*) FROM Orders")[0] == [(2,)]
+    assert sqlite3.connect(db_path).execute("SELECT COUNT(*) FROM Orders").fetchone() == (2,)
+
+
+def test_execute_arrow_adbc(db_path):
+    pytest.importorskip("adbc_driver_sqlite.dbapi")
+    tool = SQLiteTool(db_path)
+    table, error, columns = tool.execute_arrow("SELECT OrderID, CustomerID FROM Orders ORDER BY OrderID")
+    assert error is None and columns == ["OrderID", "CustomerID"]
+    assert table.to_pydict() == {"OrderID": [1, 2], "CustomerID": ["ALFKI", "BONAP"]}
+    # One ADBC connection per thread, reused and released by close()
+    tool.execute_arrow("SELECT 1")
+    assert len(tool._connections) == 2
+    # Sees writes made through execute()
+    tool.execute("DELETE FROM Orders WHERE OrderID = 1")
+    assert tool.execute_arrow("SELECT COUNT(*) AS n FROM Orders")[0].to_pydict() == {"n": [1]}
+    assert tool.execute_arrow("SELECT * FROM Missing")[0] is None
+    tool.close()
+    assert tool._connections == []
+
+
+def test_execute_arrow_pyarrow_only(db_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    monkeypatch.setattr(sqlite_tool, "adbc_sqlite", None)
+    tool = SQLiteTool(db_path)
+    table, error, columns = tool.execute_arrow("SELECT OrderID, CustomerID FROM Orders ORDER BY OrderID")
+    assert error is None and columns == ["OrderID", "CustomerID"]
+    assert table.to_pydict() == {"OrderID": [1, 2], "CustomerID": ["ALFKI", "BONAP"]}
+    # Empty results keep their columns; mixed-type columns become strings
+    empty = tool.execute_arrow("SELECT OrderID FROM Orders WHERE 0")[0]
+    assert (empty.column_names, empty.num_rows) == (["OrderID"], 0)
+    mixed = tool.execute_arrow("SELECT 1 AS v UNION ALL SELECT 'a'")[0]
+    assert mixed.to_pydict() == {"v": ["1", "a"]}
+    table, error, _ = tool.execute_arrow("SELECT * FROM Missing")
+    assert table is None and "no such table" in error
+
+
+def test_execute_arrow_without_pyarrow(db_path, monkeypatch):
+    monkeypatch.setattr(sqlite_tool, "pa", None)
+    tool = SQLiteTool(db_path)
+    rows, error, columns = tool.execute_arrow("SELECT OrderID FROM Orders ORDER BY OrderID")
+    assert (rows, error, columns) == ([{"OrderID": 1}, {"OrderID": 2}], None, ["OrderID"])
+    # Writes always take the execute() path
+    assert tool.execute_arrow("DELETE FROM Orders") == (None, None, [])
+    assert tool.execute("SELECT COUNT(*) FROM Orders")[0] == [(0,)]
+
+
+def test_normalize_sql_keeps_quoted_text():
+    query = """SELECT  [Order  Details].x,  `a  b`, "c  d", 'e  f'  -- note  here
+    FROM   [Order  Details]"""
+    assert sqlite_tool._normalize_sql(query) == (
+        """SELECT [Order  Details].x, `a  b`, "c  d", 'e  f' -- note  here\nFROM [Order  Details]"""
+    )